@@ -1,11 +1,17 @@
-import json
+import asyncio
+import html
 import logging
+import multiprocessing
 import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 from datetime import datetime, timezone
-from typing import Dict, Any, Tuple, List, Set, Optional
+from typing import AbstractSet, Dict, Any, Tuple, List, Set, Optional, Iterator
 
-from openpyxl import Workbook
+import ijson
+import xlsxwriter
+import xxhash
 from telegram import Update, Document
 from telegram.constants import ChatAction
 from telegram.ext import (
@@ -16,7 +22,7 @@ from telegram.ext import (
     filters,
 )
 
-from bs4 import BeautifulSoup 
+from selectolax.lexbor import LexborHTMLParser
 
 BOT_TOKEN = "BOT_TOKEN"
 
@@ -30,8 +36,34 @@ logger = logging.getLogger("chat_export_bot")
 MAX_FILES = 10
 LIST_THRESHOLD = 50
 TELEGRAM_MSG_LIMIT = 4096
+EXCEL_HEADERS = ("export_date", "username", "first_name", "last_name", "bio")
+
+_EXCEL_DEFAULTS = ("", "", "", "", "N/A")
+_POOL: Optional[ProcessPoolExecutor] = None
 
 MENTION_RE = re.compile(r"(?<!\w)@([A-Za-z0-9_]{5,32})")
+_EMPTY_SET = frozenset()
+
+_HTML_BLOCK_RE = re.compile(
+    rb"""<div\b[^>]*?\sclass=["'](?:[^"']*\s)?(from_name|text)(?:\s[^"']*)?["'][^>]*>(.*?)</div>""",
+    re.DOTALL,
+)
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_HTML_SKIP_RE = re.compile(rb"<!--.*?-->|<script\b.*?</script\s*>", re.DOTALL | re.IGNORECASE)
+_HTML_DETAILS_RE = re.compile(rb"""<span\b[^>]*\sclass=["'][^"']*\bdetails\b[^"']*["'][^>]*>.*?</span>""", re.DOTALL)
+
+DELETED_MARKERS = ("deleted account",)
+DELETED_WORD_PAIRS = (("удал", "аккаунт"),)
+DELETED_EXACT_NAMES = ("deleted",)
+
+_DELETED_RE = re.compile(
+    "|".join(
+        [re.escape(s) for s in DELETED_MARKERS]
+        + [f"{re.escape(a)}.*{re.escape(b)}|{re.escape(b)}.*{re.escape(a)}" for a, b in DELETED_WORD_PAIRS]
+        + [rf"\A\s*{re.escape(s)}\s*\Z" for s in DELETED_EXACT_NAMES]
+    ),
+    re.IGNORECASE | re.DOTALL,
+)
 
 
 def _safe_str(x: Any) -> str:
@@ -51,14 +83,7 @@ def _split_name(full_name: str) -> Tuple[str, str]:
 
 
 def _is_deleted_account(name: str, user_id: str) -> bool:
-    n = _safe_str(name).lower()
-    if "deleted account" in n:
-        return True
-    if "удал" in n and "аккаунт" in n:
-        return True
-    if n == "deleted":
-        return True
-    return False
+    return bool(name) and _DELETED_RE.search(name) is not None
 
 
 def _make_user_key(user_id: str, username: str, first_name: str, last_name: str) -> str:
@@ -69,130 +94,221 @@ def _make_user_key(user_id: str, username: str, first_name: str, last_name: str)
     return f"n:{first_name.lower()}|{last_name.lower()}"
 
 
-def extract_mentions_from_text(text: str) -> Set[str]:
-    return {m.group(1).lower() for m in MENTION_RE.finditer(text or "")}
+def extract_mentions_from_text(text: str) -> AbstractSet[int]:
+    if not text or "@" not in text:
+        return _EMPTY_SET
+    return {xxhash.xxh64_intdigest(m.group(1).lower().encode()) for m in MENTION_RE.finditer(text)}
 
 
-def extract_from_json(data: Dict[str, Any]) -> Tuple[str, Dict[str, Dict[str, str]], Set[str]]:
-    export_date = _safe_str(data.get("export_date")) or datetime.now(timezone.utc).isoformat()
-    participants: Dict[str, Dict[str, str]] = {}
-    mentions: Set[str] = set()
+def _watch_export_date(events: Iterator[Tuple[str, str, Any]], found: Dict[str, str]) -> Iterator[Tuple[str, str, Any]]:
+    for prefix, event, value in events:
+        if prefix == "export_date" and event in ("string", "number"):
+            found["export_date"] = _safe_str(value)
+        yield prefix, event, value
 
-    messages = data.get("messages")
-    if not isinstance(messages, list):
-        return export_date, participants, mentions
 
-    for m in messages:
+def extract_from_json(raw: bytes) -> Tuple[str, Dict[str, Dict[str, str]], Set[int]]:
+    try:
+        return _extract_from_json(raw)
+    except (ijson.JSONError, UnicodeDecodeError):
+        fixed = raw.decode("utf-8", errors="replace").encode("utf-8")
+        if fixed == raw:
+            raise
+        return _extract_from_json(fixed)
+
+
+def _extract_from_json(raw: bytes) -> Tuple[str, Dict[str, Dict[str, str]], Set[int]]:
+    found: Dict[str, str] = {}
+    participants: Dict[str, Dict[str, str]] = {}
+    mentions: Set[int] = set()
+
+    gs = _safe_str
+    split_name = _split_name
+    is_deleted = _is_deleted_account
+    make_key = _make_user_key
+    find = MENTION_RE.finditer
+    digest = xxhash.xxh64_intdigest
+    mupd = mentions.update
+
+    events = _watch_export_date(ijson.parse(BytesIO(raw)), found)
+    for m in ijson.items(events, "messages.item"):
         if not isinstance(m, dict):
             continue
+        get = m.get
 
-        text_field = m.get("text")
+        text_field = get("text")
         if isinstance(text_field, str):
-            mentions |= extract_mentions_from_text(text_field)
+            if "@" in text_field:
+                mupd([digest(mm.group(1).lower().encode()) for mm in find(text_field)])
         elif isinstance(text_field, list):
-            joined = ""
             for item in text_field:
-                if isinstance(item, str):
-                    joined += item
-                elif isinstance(item, dict):
-                    joined += _safe_str(item.get("text"))
-            mentions |= extract_mentions_from_text(joined)
-
-        from_name = _safe_str(m.get("from") or m.get("actor") or m.get("sender") or "")
-        from_id = _safe_str(m.get("from_id") or m.get("actor_id") or m.get("sender_id") or "")
-        username = _safe_str(m.get("username") or m.get("from_username") or "")
-        first_name = _safe_str(m.get("first_name"))
-        last_name = _safe_str(m.get("last_name"))
+                if isinstance(item, dict):
+                    item = item.get("text")
+                if isinstance(item, str) and "@" in item:
+                    mupd([digest(mm.group(1).lower().encode()) for mm in find(item)])
+
+        from_name = gs(get("from") or get("actor") or get("sender") or "")
+        from_id = gs(get("from_id") or get("actor_id") or get("sender_id") or "")
+        username = gs(get("username") or get("from_username") or "")
+        first_name = gs(get("first_name"))
+        last_name = gs(get("last_name"))
 
         if not first_name and not last_name and from_name:
-            fn, ln = _split_name(from_name)
-            first_name = first_name or fn
-            last_name = last_name or ln
+            first_name, last_name = split_name(from_name)
 
         if not (from_id or username or first_name or last_name or from_name):
             continue
 
-        if _is_deleted_account(from_name, from_id):
+        if is_deleted(from_name, from_id):
             continue
 
-        key = _make_user_key(from_id, username, first_name, last_name)
-        participants[key] = {
-            "export_date": export_date,
-            "username": username,
-            "first_name": first_name,
-            "last_name": last_name,
-            "bio": "N/A",  
-        }
+        key = make_key(from_id, username, first_name, last_name)
+        if key not in participants:
+            participants[key] = {
+                "export_date": "",
+                "username": username,
+                "first_name": first_name,
+                "last_name": last_name,
+                "bio": "N/A",
+            }
+
+    export_date = found.get("export_date") or datetime.now(timezone.utc).isoformat()
+    for p in participants.values():
+        p["export_date"] = export_date
 
     return export_date, participants, mentions
 
 
-def extract_from_html(html_bytes: bytes) -> Tuple[str, Dict[str, Dict[str, str]], Set[str]]:
-    text = html_bytes.decode("utf-8", errors="replace")
-    soup = BeautifulSoup(text, "lxml")
+def _html_block_text(raw: bytes) -> str:
+    text = _HTML_TAG_RE.sub(" ", raw.decode("utf-8", errors="replace"))
+    return " ".join(html.unescape(text).split())
+
+
+def _iter_html_blocks(html_bytes: bytes) -> Iterator[Tuple[bytes, str]]:
+    html_bytes = _HTML_SKIP_RE.sub(b"", html_bytes)
+
+    matched: Set[bytes] = set()
+    nested: Set[bytes] = set()
+    for m in _HTML_BLOCK_RE.finditer(html_bytes):
+        kind, body = m.group(1), m.group(2)
+        if b"<div" in body:
+            nested.add(kind)
+            continue
+        matched.add(kind)
+        if kind == b"from_name":
+            body = _HTML_DETAILS_RE.sub(b" ", body)
+        yield kind, _html_block_text(body)
+
+    dom_kinds = [k for k in (b"from_name", b"text") if k not in matched or k in nested]
+    if not dom_kinds:
+        return
+
+    tree = LexborHTMLParser(html_bytes)
+    for kind in dom_kinds:
+        for node in tree.css("." + kind.decode()):
+            if kind == b"from_name":
+                for details in node.css(".details"):
+                    details.decompose()
+            yield kind, node.text(deep=True, separator=" ", strip=True)
 
+
+def extract_from_html(html_bytes: bytes) -> Tuple[str, Dict[str, Dict[str, str]], Set[int]]:
     export_date = datetime.now(timezone.utc).isoformat()
     participants: Dict[str, Dict[str, str]] = {}
-    mentions: Set[str] = set()
+    mentions: Set[int] = set()
 
-    for name_tag in soup.select(".from_name"):
-        from_name = _safe_str(name_tag.get_text())
+    for kind, value in _iter_html_blocks(html_bytes):
+        if kind == b"text":
+            mentions |= extract_mentions_from_text(_safe_str(value))
+            continue
+
+        from_name = _safe_str(value)
         if not from_name:
             continue
         if _is_deleted_account(from_name, ""):
             continue
         fn, ln = _split_name(from_name)
         key = _make_user_key("", "", fn, ln)
-        participants[key] = {
-            "export_date": export_date,
-            "username": "",
-            "first_name": fn,
-            "last_name": ln,
-            "bio": "N/A",
-        }
-
-    for text_tag in soup.select(".text"):
-        msg_text = _safe_str(text_tag.get_text())
-        mentions |= extract_mentions_from_text(msg_text)
+        if key not in participants:
+            participants[key] = {
+                "export_date": export_date,
+                "username": "",
+                "first_name": fn,
+                "last_name": ln,
+                "bio": "N/A",
+            }
 
     return export_date, participants, mentions
 
 
-def build_excel_bytes(rows: List[Dict[str, str]]) -> bytes:
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "users"
-
-    headers = ["export_date", "username", "first_name", "last_name", "bio"]
-    ws.append(headers)
-
-    for r in rows:
-        ws.append([
-            r.get("export_date", ""),
-            r.get("username", ""),
-            r.get("first_name", ""),
-            r.get("last_name", ""),
-            r.get("bio", "N/A"),
-        ])
+def _parse_one(name: str, raw: bytes) -> Tuple[Dict[str, Dict[str, str]], Set[int]]:
+    if name.endswith(".json"):
+        _, participants, mentions = extract_from_json(raw)
+    else:
+        _, participants, mentions = extract_from_html(raw)
+    return participants, mentions
 
+
+def build_excel_bytes(rows: List[Dict[str, str]]) -> bytes:
     bio = BytesIO()
-    wb.save(bio)
+    wb = xlsxwriter.Workbook(bio, {
+        "in_memory": True,
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+    })
+    ws = wb.add_worksheet("users")
+
+    ws.write_row(0, 0, EXCEL_HEADERS)
+
+    for i, r in enumerate(rows, start=1):
+        ws.write_row(i, 0, (r.get(h, d) for h, d in zip(EXCEL_HEADERS, _EXCEL_DEFAULTS)))
+
+    wb.close()
     return bio.getvalue()
 
 
 def chunk_text(text: str, limit: int = TELEGRAM_MSG_LIMIT) -> List[str]:
+    size = max(limit - 50, 1)
     chunks = []
-    cur = ""
-    for line in text.splitlines(True):
-        if len(cur) + len(line) > limit - 50:
-            chunks.append(cur)
-            cur = ""
-        cur += line
-    if cur:
-        chunks.append(cur)
+    start = 0
+    end_of_text = len(text)
+    while end_of_text - start > size:
+        nl = text.rfind("\n", start, start + size)
+        if nl != -1:
+            end = nl + 1
+        else:
+            end = start + size
+            if text.startswith("\n", end):
+                end += 1
+        if text[start:end].strip():
+            chunks.append(text[start:end])
+        start = end
+    if text[start:].strip():
+        chunks.append(text[start:])
     return chunks
 
 
+def _get_pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return _POOL
+
+
+async def _parse_in_pool(name: str, raw: bytes) -> Tuple[Dict[str, Dict[str, str]], Set[int]]:
+    global _POOL
+    pool = _get_pool()
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, _parse_one, name, raw)
+    except BrokenProcessPool:
+        logger.warning("Parser worker died, restarting it on the next upload")
+        pool.shutdown(wait=False, cancel_futures=True)
+        if _POOL is pool:
+            _POOL = None
+        raise
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     context.user_data["files"] = []
     await update.message.reply_text(
@@ -232,12 +348,9 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         tg_file = await context.bot.get_file(doc.file_id)
         buf = BytesIO()
         await tg_file.download_to_memory(out=buf)
-        raw = buf.getvalue()
-
-        if filename.endswith(".json"):
-            json.loads(raw.decode("utf-8", errors="replace"))
+        participants, mentions = await _parse_in_pool(filename, buf.getvalue())
 
-        files.append({"name": filename, "bytes": raw})
+        files.append({"name": filename, "participants": participants, "mentions": mentions})
         context.user_data["files"] = files
 
         await msg.reply_text(f"✅ Принял: {filename} ({len(files)}/{MAX_FILES}). Пришли ещё или /done.")
@@ -257,40 +370,26 @@ async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await msg.chat.send_action(action=ChatAction.TYPING)
 
     all_participants: Dict[str, Dict[str, str]] = {}
-    all_mentions: Set[str] = set()
-
-    processed = 0
-    failed = 0
+    all_mentions: Set[int] = set()
 
     for f in files:
-        name = f["name"]
-        raw = f["bytes"]
-        try:
-            if name.endswith(".json"):
-                data = json.loads(raw.decode("utf-8", errors="replace"))
-                _, participants, mentions = extract_from_json(data)
-            else:
-                _, participants, mentions = extract_from_html(raw)
-
-            all_participants.update(participants)
-            all_mentions |= mentions
-            processed += 1
-        except Exception:
-            failed += 1
+        all_participants.update(f["participants"])
+        all_mentions |= f["mentions"]
 
+    processed = len(files)
     context.user_data["files"] = []
 
     total = len(all_participants)
 
     if total == 0:
         await msg.reply_text(
-            f"Готово. Файлов обработано: {processed}, ошибок: {failed}.\n"
+            f"Готово. Файлов обработано: {processed}.\n"
             "Не нашёл участников (возможно, формат экспорта отличается)."
         )
         return
 
     await msg.reply_text(
-        f"Готово. Файлов: {processed}, ошибок: {failed}.\n"
+        f"Готово. Файлов: {processed}.\n"
         f"Уникальных участников (писали сообщения): {total}\n"
         f"Уникальных @упоминаний в тексте (не участники): {len(all_mentions)}"
     )
@@ -358,6 +457,9 @@ def main() -> None:
     print("=== BOT STARTED OK ===")
     app.run_polling()
 
+    if _POOL is not None:
+        _POOL.shutdown()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,163 @@
+import random
+from pathlib import Path
+
+import bot
+
+SAMPLE_EXPORT = Path(__file__).resolve().parent.parent / "test.json"
+
+
+def test_extract_from_json_sample_export():
+    export_date, participants, mentions = bot.extract_from_json(SAMPLE_EXPORT.read_bytes())
+
+    assert export_date == "2026-02-01T12:00:00Z"
+    assert set(participants) == {"id:user123", "id:user456"}
+    assert participants["id:user456"]["first_name"] == "Petr"
+    assert participants["id:user456"]["last_name"] == "Petrov"
+    assert len(mentions) == 1
+
+
+def test_extract_from_json_export_date_after_messages():
+    raw = (
+        b'{"messages": [{"from": "Ivan Ivanov", "from_id": "user1", "text": "hi"}],'
+        b' "export_date": "2026-03-01T10:00:00Z"}'
+    )
+    export_date, participants, _ = bot.extract_from_json(raw)
+
+    assert export_date == "2026-03-01T10:00:00Z"
+    assert participants["id:user1"]["export_date"] == "2026-03-01T10:00:00Z"
+
+
+def test_extract_from_json_invalid_utf8():
+    raw = b'{"messages": [{"from": "Iv\xff an", "from_id": "user1", "text": "@somebody"}]}'
+    _, participants, mentions = bot.extract_from_json(raw)
+
+    assert set(participants) == {"id:user1"}
+    assert len(mentions) == 1
+
+
+def _old_chunk_text(text, limit):
+    chunks = []
+    cur = ""
+    for line in text.splitlines(True):
+        if len(cur) + len(line) > limit - 50:
+            chunks.append(cur)
+            cur = ""
+        cur += line
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+
+def test_chunk_text_matches_line_based_split():
+    rng = random.Random(0)
+    for _ in range(500):
+        text = "".join("x" * rng.randint(1, 300) + "\n" for _ in range(rng.randint(0, 60)))
+        assert bot.chunk_text(text, 400) == _old_chunk_text(text, 400)
+
+
+def test_chunk_text_small_limit_terminates():
+    assert bot.chunk_text("abc", 50) == ["a", "b", "c"]
+
+
+def test_chunk_text_no_whitespace_only_chunks():
+    chunks = bot.chunk_text("a" * 100 + "\n" + "a" * 100, 150)
+
+    assert chunks == ["a" * 100 + "\n", "a" * 100]
+    assert all(c.strip() for c in chunks)
+
+
+SAMPLE_HTML = """
+<div class="message service" id="message-1">
+ <div class="body details">1 February 2026</div>
+</div>
+<div class="message default clearfix" id="message1">
+ <div class="pull_left userpic_wrap">
+  <div class="userpic userpic1" style="width: 42px; height: 42px">
+   <div class="initials" style="line-height: 42px">II</div>
+  </div>
+ </div>
+ <div class="body">
+  <div class="pull_right date details" title="01.02.2026 12:01:00 UTC+03:00">12:01</div>
+  <div class="from_name">
+Ivan Ivanov
+  </div>
+  <div class="text">
+Ответ <a href="https://t.me/petrov_p">@petrov_p</a> &amp; <strong>всем</strong>
+  </div>
+ </div>
+</div>
+<div class="message default clearfix joined" id="message2">
+ <div class="body">
+  <div class="text">
+Tom &amp; Jerry say hi to @jerry_mouse
+  </div>
+ </div>
+</div>
+<div class="message default clearfix" id="message3">
+ <div class="body">
+  <div class="from_name">
+Petr Petrov
+  </div>
+  <div class="forwarded body">
+   <div class="from_name">
+Anna Smith<span class="date details" title="21.01.2026 10:00:00 UTC+03:00"> 21.01.2026 10:00:00</span>
+   </div>
+   <div class="text">
+Forwarded text
+   </div>
+  </div>
+ </div>
+</div>
+<div class="message default clearfix" id="message4">
+ <div class="body">
+  <div class="from_name">
+Deleted Account
+  </div>
+  <div class="text">
+gone
+  </div>
+ </div>
+</div>
+""".encode("utf-8")
+
+
+def test_extract_from_html_telegram_export():
+    _, participants, mentions = bot.extract_from_html(SAMPLE_HTML)
+
+    assert set(participants) == {"n:ivan|ivanov", "n:petr|petrov", "n:anna|smith"}
+    assert mentions == bot.extract_mentions_from_text("@petrov_p @jerry_mouse")
+
+
+def test_extract_from_html_quotes_and_multi_class():
+    raw = b"""<div class='from_name'>Anna Petrova</div><div id="m1" class="text bold">hi @someone_x</div>"""
+    _, participants, mentions = bot.extract_from_html(raw)
+
+    assert set(participants) == {"n:anna|petrova"}
+    assert mentions == bot.extract_mentions_from_text("@someone_x")
+
+
+def test_extract_from_html_nested_div_uses_dom():
+    raw = b"""<div class="from_name">Ivan Ivanov</div><div class="text">a <div>b</div> @after_nested</div>"""
+    _, _, mentions = bot.extract_from_html(raw)
+
+    assert mentions == bot.extract_mentions_from_text("@after_nested")
+
+
+def test_extract_from_html_falls_back_per_kind():
+    raw = b"""<div class=from_name>Anna Petrova</div><div class="text">hi @someone_x</div>"""
+    _, participants, mentions = bot.extract_from_html(raw)
+
+    assert set(participants) == {"n:anna|petrova"}
+    assert mentions == bot.extract_mentions_from_text("@someone_x")
+
+
+def test_extract_from_html_ignores_comments_and_scripts():
+    raw = b"""
+<!-- <div class="from_name">Ghost User</div> -->
+<script>var tpl = '<div class="from_name">Script Guy</div>';</script>
+<div class="from_name">Ivan Ivanov</div>
+<div class="text">hello</div>
+"""
+    _, participants, _ = bot.extract_from_html(raw)
+
+    assert set(participants) == {"n:ivan|ivanov"}